@@ -55,6 +55,10 @@ class CheckpointCallback(Callback):
         点继续训练。如果保存的是 ``Model`` 对象，则可以通过 :meth:`Trainer.load_model` 加载该模型权重。
     :param save_evaluate_results: 是否保存 evaluate 的结果。如果为 ``True`` ，在保存 topk 模型的 folder 中还将额外保存一个
         ``fastnlp_evaluate_results.json`` 文件，记录当前的 results。仅在设置了 ``topk`` 的场景下有用，默认为 ``True`` 。
+    :param async_save: 是否在后台子进程中进行模型权重的写盘操作，从而减少保存时训练被阻塞的时间。子进程通过 ``spawn`` 的方式启动，
+        请确保训练脚本的入口处有 ``if __name__ == '__main__':`` 的保护。目前仅支持 ``TorchSingleDriver`` 与 ``TorchDDPDriver`` ，
+        且要求 ``only_state_dict=True`` 、 ``model_save_fn=None`` ，其它情况下会退回到同步保存。使用 ``TorchDDPDriver`` 时还会额外
+        创建一个 gloo 通信组，用于保存前后的同步。默认为 ``False`` 。
     :param kwargs:
     """
     def __init__(self, folder: Optional[Union[str, Path]] = None, every_n_epochs: Optional[int] = None,
@@ -62,7 +66,7 @@ class CheckpointCallback(Callback):
                  on_exceptions: Optional[Union[BaseException, Sequence[BaseException]]] = (EarlyStopException),
                  monitor: Optional[Union[str, Callable]] = None, larger_better: bool = True,
                  only_state_dict: bool = True, model_save_fn: Optional[Callable] = None, save_object: str = 'model',
-                 save_evaluate_results=True, **kwargs):
+                 save_evaluate_results=True, async_save: bool = False, **kwargs):
         super().__init__()
         if every_n_epochs is not None:
             if not isinstance(every_n_epochs, int) or every_n_epochs < 1:
@@ -89,7 +93,7 @@ class CheckpointCallback(Callback):
 
         self.topk_saver = TopkSaver(topk=topk, monitor=monitor, larger_better=larger_better, folder=folder,
                                     save_object=save_object, only_state_dict=only_state_dict, model_save_fn=model_save_fn,
-                                    save_evaluate_results=save_evaluate_results, **kwargs)
+                                    save_evaluate_results=save_evaluate_results, async_save=async_save, **kwargs)
         self.topk_saver.log_name = self.__class__.__name__
 
         self.topk = topk
@@ -105,6 +109,7 @@ class CheckpointCallback(Callback):
         return self.save_object == 'trainer'
 
     def on_after_trainer_initialized(self, trainer, driver):
+        self.topk_saver.init_checkpoint_group(driver)
         if self.topk_saver.topk_queue:  # 需要设置 monitor
             if self.topk_saver.monitor is None:
                 self.topk_saver.set_monitor(monitor=trainer.monitor, larger_better=trainer.larger_better)
@@ -134,6 +139,10 @@ class CheckpointCallback(Callback):
                           f'exception_{exception.__class__.__name__}'
             self.topk_saver.save(trainer, folder_name=folder_name)
 
+    def on_train_end(self, trainer):
+        # 等待异步保存的任务全部完成
+        self.topk_saver.teardown()
+
     def on_save_checkpoint(self, trainer) -> Dict:
         states = {}
         states['topk_saver'] = self.topk_saver.state_dict()
@@ -24,6 +24,9 @@ class CanItemDataType(ABC):
         return NotImplemented
 
 
+_BUILTIN_SCALAR_TYPES = (int, float, str, bool, type(None))
+
+
 class ResultsMonitor:
     """
     可用于监控某个数值，并通过 :meth:`is_better_results` 等接口检测结果是否变得更好。
@@ -52,6 +55,8 @@ class ResultsMonitor:
             self.monitor = str(monitor) if monitor is not None else None
         if self.monitor is not None:
             self.larger_better = bool(larger_better)
+            # 乘上 _sign 之后，统一为越大越好
+            self._sign = 1 if self.larger_better else -1
         if larger_better:
             self.monitor_value = float('-inf')
         else:
@@ -65,6 +70,10 @@ class ResultsMonitor:
         :param results:
         :return:
         """
+        # 常见情况下 results 中都已经是 python 内置类型，此时不需要再逐个元素地进行类型检查；与 apply_to_collection 一样返回
+        # 新的 dict ，因为 results 会被所有 callback 共享，调用方可能会修改返回的结果
+        if isinstance(results, dict) and all(type(value) in _BUILTIN_SCALAR_TYPES for value in results.values()):
+            return dict(results)
         return apply_to_collection(results, dtype=CanItemDataType, function=lambda x: x.item())
 
     def get_monitor_value(self, results:Dict)->Union[float, None]:
@@ -140,11 +149,7 @@ class ResultsMonitor:
             return False
         if monitor_value2 is None:
             return True
-        better = False
-        if (self.larger_better and monitor_value1 > monitor_value2) or \
-                (not self.larger_better and monitor_value1 < monitor_value2):
-            better = True
-        return better
+        return self._sign * monitor_value1 > self._sign * monitor_value2
 
     @property
     def monitor_name(self):
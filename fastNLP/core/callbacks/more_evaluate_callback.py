@@ -122,6 +122,7 @@ class MoreEvaluateCallback(HasMonitorCallback):
         return self.topk_saver.save_object == 'trainer'
 
     def on_after_trainer_initialized(self, trainer, driver):
+        self.topk_saver.init_checkpoint_group(driver)
         # 如果是需要 watch 的，不能没有 evaluator
         if self.monitor is not None:
             assert trainer.evaluator is not None, f"You set `watch_monitor={self.monitor}`, but no " \
@@ -179,6 +180,9 @@ class MoreEvaluateCallback(HasMonitorCallback):
             results = self.evaluator.run()
             self.topk_saver.save_topk(trainer, results)
 
+    def on_train_end(self, trainer):
+        self.topk_saver.teardown()
+
     def on_save_checkpoint(self, trainer) -> Dict:
         states = {'topk_saver': self.topk_saver.state_dict()}
         if isinstance(self._real_monitor, str):
@@ -3,16 +3,20 @@ __all__ = [
 ]
 import json
 import os
-from copy import deepcopy
+import stat
+import heapq
+from functools import partial
 from pathlib import Path
 from typing import Optional, Dict, Tuple, Callable, Union
 
 from ...envs.distributed import rank_zero_rm
 from fastNLP.core.log import logger
 from fastNLP.envs import FASTNLP_LAUNCH_TIME
-from fastNLP.envs import rank_zero_call
-from fastNLP.envs.env import FASTNLP_EVALUATE_RESULT_FILENAME
+from fastNLP.envs import rank_zero_call, fastnlp_no_sync_context
+from fastNLP.envs.env import FASTNLP_EVALUATE_RESULT_FILENAME, FASTNLP_MODEL_FILENAME
 from .has_monitor_callback import ResultsMonitor
+from .torch_callbacks.checkpoint_worker import _CheckpointWorker, _StagingPlan, _stage_state_dict, \
+    _new_checkpoint_group, _checkpoint_barrier
 
 
 class Saver:
@@ -30,17 +34,26 @@ class Saver:
     :param only_state_dict: 保存时是否仅保存权重，在 model_save_fn 不为 None 时无意义。
     :param model_save_fn: 个性化的保存函数，当触发保存操作时，就调用这个函数，这个函数应当接受一个文件夹作为参数，不返回任何东西。
         如果传入了 model_save_fn 函数，fastNLP 将不再进行模型相关的保存。在多卡场景下，我们只在 rank 0 上会运行该函数。
+    :param async_save: 是否在后台子进程中进行模型权重的写盘操作。为 ``True`` 时，训练进程只负责将权重拷贝到内存中，序列化和写盘
+        由一个通过 ``spawn`` 方式启动的子进程完成，因此请确保训练脚本的入口处有 ``if __name__ == '__main__':`` 的保护。目前仅支持
+        ``TorchSingleDriver`` 与 ``TorchDDPDriver`` ，且要求 ``only_state_dict=True`` 、 ``model_save_fn=None`` ，其它情况下
+        会退回到同步保存。
     :param kwargs: 更多需要传递给 Trainer.save_checkpoint() 或者 Trainer.save_model() 接口的参数。
     """
     def __init__(self, folder:str=None, save_object:str='model', only_state_dict:bool=True,
-                 model_save_fn:Callable=None, **kwargs):
+                 model_save_fn:Callable=None, async_save:bool=False, **kwargs):
         if folder is None:
             folder = Path.cwd().absolute()
         folder = Path(folder)
-        if not folder.exists():
-            folder.mkdir(parents=True, exist_ok=True)
-        elif folder.is_file():
-            raise ValueError("Parameter `folder` should be a directory instead of a file.")
+        # 只通过一次 stat 同时判断是否存在以及是否为文件，在网络文件系统上可以减少一次往返
+        try:
+            folder_stat = os.stat(folder)
+        except FileNotFoundError:
+            # 之后每次保存时都会以 parents=True 的方式创建子文件夹，因此这里只需要 rank 0 创建即可
+            rank_zero_call(folder.mkdir)(parents=True, exist_ok=True)
+        else:
+            if stat.S_ISREG(folder_stat.st_mode):
+                raise ValueError("Parameter `folder` should be a directory instead of a file.")
 
         self.folder = folder
         self.only_state_dict = only_state_dict
@@ -48,6 +61,14 @@ class Saver:
         self.kwargs = kwargs
         self.save_object = save_object
         self.save_fn_name = 'save_checkpoint' if save_object == 'trainer' else 'save_model'
+        # 子进程只会在第一次真正发生异步保存时启动
+        self.checkpoint_worker = _CheckpointWorker() if async_save else None
+        # 异步保存时的保存计划，只与模型的 state_dict 拓扑结构有关，因此只需要在第一次保存时生成
+        self._cached_save_plan = None
+        # 异步保存时被 topk 淘汰的 folder_name ，需要等到新的 checkpoint 确认写盘成功之后才删除
+        self._deferred_rm = []
+        # 保存时用于同步的独立通信组，通过 init_checkpoint_group() 设置
+        self.checkpoint_group = None
 
         self.timestamp_path = self.folder.joinpath(os.environ[FASTNLP_LAUNCH_TIME])
         # 打印这次运行时 checkpoint 所保存在的文件夹，因为这个文件夹是根据时间实时生成的，因此需要打印出来防止用户混淆；
@@ -66,20 +87,120 @@ class Saver:
         :return: 实际发生保存的 folder 绝对路径。如果为 None 则没有创建。
         """
         folder = self.timestamp_path.joinpath(folder_name)
+        # 这里需要所有 rank 都创建，因为部分 driver （例如 TorchFSDPDriver 与 DeepSpeedDriver）会在每个 rank 上向该文件夹写入文件
         folder.mkdir(parents=True, exist_ok=True)
 
+        model_save_fn = self.model_save_fn
+        if self.checkpoint_worker is not None and self._support_async_save(trainer):
+            model_save_fn = partial(self._async_model_save, trainer)
+
         save_fn = getattr(trainer, self.save_fn_name)
-        save_fn(
-            folder=folder,
-            only_state_dict=self.only_state_dict,
-            model_save_fn=self.model_save_fn,
-            **self.kwargs
-        )
+        if self.checkpoint_group is not None:
+            # 保存前后的同步在独立的通信组上进行，同时关闭 trainer 内部使用训练通信组的 barrier
+            _checkpoint_barrier(self.checkpoint_group)
+            with fastnlp_no_sync_context(level=1):
+                save_fn(
+                    folder=folder,
+                    only_state_dict=self.only_state_dict,
+                    model_save_fn=model_save_fn,
+                    **self.kwargs
+                )
+            _checkpoint_barrier(self.checkpoint_group)
+        else:
+            save_fn(
+                folder=folder,
+                only_state_dict=self.only_state_dict,
+                model_save_fn=model_save_fn,
+                **self.kwargs
+            )
         # TODO 如果 Metric 没有进行聚集操作，此时会创建出多个文件夹且只在 rank 0 的文件夹中进行保存
         # 可能的解决方法：检测出空文件夹并且删除
 
         return str(os.path.abspath(folder))
 
+    def init_checkpoint_group(self, driver):
+        """
+        在使用 ``async_save`` 的 torch 分布式训练中，创建一个独立的 gloo 通信组用于保存前后的同步，避免与训练使用的 NCCL
+        通信组争抢。该函数需要在所有 rank 上调用；没有使用 ``async_save`` 或者不支持异步保存时不做任何操作，此时保存的行为与之前
+        完全一致。
+
+        :param driver: trainer 使用的 driver；
+        """
+        if self.checkpoint_group is None and self.checkpoint_worker is not None and self.only_state_dict \
+                and self.model_save_fn is None:
+            self.checkpoint_group = _new_checkpoint_group(driver)
+
+    def _support_async_save(self, trainer) -> bool:
+        """
+        判断当前的 driver 与保存参数是否支持异步保存。
+        """
+        support = False
+        if self.only_state_dict and self.model_save_fn is None:
+            try:
+                from fastNLP.core.drivers.torch_driver import TorchSingleDriver, TorchDDPDriver
+                support = type(trainer.driver) in (TorchSingleDriver, TorchDDPDriver)
+            except ImportError:
+                support = False
+        if not support:
+            logger.rank_zero_warning(f"`async_save` is not supported for driver:{trainer.driver.__class__.__name__} "
+                                     f"with only_state_dict={self.only_state_dict} and model_save_fn="
+                                     f"{self.model_save_fn}, the checkpoint will be saved synchronously.", once=True)
+        return support
+
+    def _async_model_save(self, trainer, folder):
+        """
+        作为 ``model_save_fn`` 传给 trainer，只在 rank 0 上被调用。将模型权重拷贝到内存后交由子进程保存为
+        ``FASTNLP_MODEL_FILENAME`` ，保存的格式与 driver 同步保存时一致。
+        """
+        state_dict = trainer.driver.unwrap_model().state_dict()
+        # 缓冲区会被复用，需要等待上一次的保存完成
+        self._wait_for_async_save()
+        if self._cached_save_plan is None or not self._cached_save_plan.match(state_dict):
+            self._reset_save_plan()
+            self._cached_save_plan = _StagingPlan(state_dict)
+        states = _stage_state_dict(state_dict, self._cached_save_plan)
+        self.checkpoint_worker.submit(Path(folder).joinpath(FASTNLP_MODEL_FILENAME), states)
+
+    def teardown(self):
+        """
+        等待所有异步保存的任务完成，并结束保存的子进程。该函数在训练结束时调用，保存失败的任务只会通过 logger 报告，而不会抛出
+        异常。在没有使用 ``async_save`` 时不做任何操作。
+        """
+        if self.checkpoint_worker is not None:
+            try:
+                try:
+                    self._wait_for_async_save()
+                finally:
+                    self.checkpoint_worker.close()
+            except:
+                logger.exception(f"Fail to finish the asynchronous checkpoint saving in {self.timestamp_path}")
+            finally:
+                self._reset_save_plan()
+
+    def _wait_for_async_save(self):
+        """
+        等待已经提交的异步保存任务完成，之后再删除在此期间被 topk 淘汰的文件夹。如果保存失败，会抛出异常并保留这些文件夹。
+        """
+        deferred_rm, self._deferred_rm = self._deferred_rm, []
+        self.checkpoint_worker.wait_for_pending()
+        for folder_name in deferred_rm:
+            self.rm(folder_name)
+
+    def _rm_after_saved(self, folder_name):
+        """
+        删除 ``folder_name`` 。如果还有没有完成的异步保存任务，则推迟到这些任务确认成功之后再删除，避免保存失败时新旧
+        checkpoint 都丢失。
+        """
+        if self.checkpoint_worker is not None and self.checkpoint_worker.has_pending:
+            self._deferred_rm.append(folder_name)
+        else:
+            self.rm(folder_name)
+
+    def _reset_save_plan(self):
+        if self._cached_save_plan is not None:
+            self._cached_save_plan.release()
+            self._cached_save_plan = None
+
     @rank_zero_call
     def save_json(self, results, path):
         """
@@ -110,6 +231,7 @@ class Saver:
         return states
 
     def load_state_dict(self, states):
+        self._reset_save_plan()
         timestamp_path = states['timestamp_path']
         if not os.path.exists(timestamp_path):
             logger.info(f"The resuming checkpoint folder {timestamp_path} is not exists, checkpoint will save to "
@@ -131,7 +253,9 @@ class TopkQueue:
     def __init__(self, topk):
         assert isinstance(topk, int)
         self.topk = topk
-        self.topk_dict = {}  # 其中 key 为保存的内容， value 是对应的性能。
+        # (value, push_idx, key) 组成的小根堆，堆顶为当前 topk 中表现最差的记录；push_idx 用于在 value 相同时先挤出更早推入的记录
+        self._topk_heap = []
+        self._push_idx = 0
 
     def push(self, key, value) -> Optional[Tuple[Union[str, None], Union[float, None]]]:
         """
@@ -150,22 +274,30 @@ class TopkQueue:
             return None, None
         if self.topk == 0:
             return key, value
-        if len(self.topk_dict)<self.topk:
-            self.topk_dict[key] = value
+        item = (value, self._push_idx, key)
+        self._push_idx += 1
+        if len(self._topk_heap) < self.topk:
+            heapq.heappush(self._topk_heap, item)
             return None, None
-        min_key = min(self.topk_dict, key=lambda x:self.topk_dict[x])
-        if self.topk_dict[min_key] > value:
-            return key, value
-        else:
-            min_value = self.topk_dict.pop(min_key)
-            self.topk_dict[key] = value
-            return min_key, min_value
+        min_value, _, min_key = heapq.heappushpop(self._topk_heap, item)
+        return min_key, min_value
+
+    @property
+    def topk_dict(self) -> Dict:
+        """
+        当前处于 topk 中的记录，其中 key 为保存的内容， value 是对应的性能。
+        """
+        return {key: value for value, _, key in sorted(self._topk_heap, key=lambda item: item[1])}
 
     def state_dict(self):
-        return deepcopy(self.topk_dict)
+        return self.topk_dict
 
     def load_state_dict(self, states):
-        self.topk_dict.update(states)
+        topk_dict = self.topk_dict
+        topk_dict.update(states)
+        self._topk_heap = [(value, idx, key) for idx, (key, value) in enumerate(topk_dict.items())]
+        self._push_idx = len(self._topk_heap)
+        heapq.heapify(self._topk_heap)
 
     def __str__(self):
         return f'topk-{self.topk}'
@@ -204,15 +336,16 @@ class TopkSaver(ResultsMonitor, Saver):
         如果传入了 ``model_save_fn`` 函数，fastNLP 将不再进行模型相关的保存。在多卡场景下，我们只在 rank 0 上会运行该函数。
     :param save_evaluate_results: 是否保存 evaluate 的结果。如果为 True ，在保存 topk 模型的 folder 中还将额外保存一个
         ``fastnlp_evaluate_results.json`` 文件，记录当前的 metric results 。仅在设置了 ``topk`` 的场景下有用，默认为 True 。
+    :param async_save: 是否在后台子进程中进行模型权重的写盘操作，详见 :class:`Saver` 。
     :param kwargs: 更多需要传递给 :meth:`Trainer.save_checkpoint` 或者 :meth:`Trainer.save_model` 接口的参数。
     """
     def __init__(self, topk:int=0, monitor:str=None, larger_better:bool=True, folder:str=None, save_object:str='model',
                  only_state_dict:bool=True, model_save_fn:Callable=None, save_evaluate_results:bool=True,
-                 **kwargs):
+                 async_save:bool=False, **kwargs):
         if topk is None:
             topk = 0
         ResultsMonitor.__init__(self, monitor, larger_better)
-        Saver.__init__(self, folder, save_object, only_state_dict, model_save_fn, **kwargs)
+        Saver.__init__(self, folder, save_object, only_state_dict, model_save_fn, async_save, **kwargs)
 
         if monitor is not None and topk == 0:
             raise RuntimeError("`monitor` is set, but `topk` is 0.")
@@ -238,7 +371,7 @@ class TopkSaver(ResultsMonitor, Saver):
                 return
             key = f"{self.save_object}-epoch_{trainer.cur_epoch_idx}-batch_{trainer.global_forward_batches}" \
                   f"-{self.monitor_name}_{monitor_value}"
-            pop_key, pop_value = self.topk_queue.push(key, monitor_value if self.larger_better else -monitor_value)
+            pop_key, pop_value = self.topk_queue.push(key, self._sign * monitor_value)
             if pop_key == key:  # 说明不足以构成 topk，被退回了
                 return None
             folder = self.save(trainer, key)
@@ -250,7 +383,7 @@ class TopkSaver(ResultsMonitor, Saver):
                     logger.exception(f"Fail to save evaluate results to {folder}")
 
             if pop_key and pop_key != key:  # 说明需要移除之前的 topk
-                self.rm(pop_key)
+                self._rm_after_saved(pop_key)
             return folder
 
     def state_dict(self):
@@ -264,6 +397,7 @@ class TopkSaver(ResultsMonitor, Saver):
         return states
 
     def load_state_dict(self, states):
+        self._reset_save_plan()
         topk_queue_states = states['topk_queue']
         self.topk_queue.load_state_dict(topk_queue_states)
 
@@ -0,0 +1,270 @@
+"""
+在后台子进程中执行模型权重写盘操作的工具，供 :class:`~fastNLP.core.callbacks.topk_saver.Saver` 的 ``async_save`` 模式使用。
+
+训练进程只负责将权重从显存拷贝到（锁页的）共享内存中，序列化以及磁盘写入由一个常驻的子进程完成，从而缩短保存 checkpoint
+时训练被阻塞的时间。
+
+在 torch 的分布式训练中，保存前后的同步操作可以通过 :func:`_new_checkpoint_group` 创建的独立 gloo 通信组完成，避免占用训练使用的
+NCCL 通信组。
+"""
+__all__ = []
+
+import os
+import queue
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+from fastNLP.envs.imports import _NEED_IMPORT_TORCH
+from fastNLP.envs.env import FASTNLP_NO_SYNC
+from fastNLP.core.log import logger
+
+if _NEED_IMPORT_TORCH:
+    import torch
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+
+
+def _new_checkpoint_group(driver):
+    """
+    为 checkpoint 的保存创建一个独立的 gloo 通信组。与 :func:`torch.distributed.new_group` 一样，需要在所有 rank 上以相同的顺序调用。
+
+    :param driver: trainer 使用的 driver；
+    :return: 创建的通信组；如果 ``driver`` 不是 ``TorchDDPDriver`` （其子类如 ``TorchFSDPDriver`` 不支持异步保存）或者没有
+        初始化分布式环境，返回 ``None`` ；
+    """
+    from fastNLP.core.drivers.torch_driver import TorchDDPDriver
+    if type(driver) is not TorchDDPDriver or not dist.is_initialized():
+        return None
+    return dist.new_group(backend='gloo')
+
+
+def _checkpoint_barrier(group):
+    """
+    在 ``group`` 上进行同步。与 driver 的 :meth:`barrier` 一样，当 ``FASTNLP_NO_SYNC`` 大于等于 1 时不执行。
+    """
+    if int(os.environ.get(FASTNLP_NO_SYNC, 0)) < 1:
+        dist.barrier(group=group)
+
+
+def _state_dict_signature(state_dict: Dict) -> Tuple:
+    """
+    获取 ``state_dict`` 的拓扑结构，即每个 key 对应 tensor 的 shape、dtype 以及是否位于 cuda 上。
+    """
+    signature = []
+    for name, value in state_dict.items():
+        if isinstance(value, torch.Tensor):
+            signature.append((name, tuple(value.shape), value.dtype, value.is_cuda))
+        else:
+            signature.append((name, None, None, None))
+    return tuple(signature)
+
+
+class _StagingPlan:
+    """
+    保存计划，由 ``state_dict`` 的拓扑结构唯一决定。其中缓存了按照该拓扑预先分配好的 cpu 缓冲区，从而只有第一次保存时才需要分配内存。
+
+    缓冲区在分配时就位于共享内存中，这样通过队列交给子进程时 torch 只需要传递共享内存的句柄，而不会在第一次传递时将其拷贝到新的
+    共享内存中（这会导致每次保存时缓冲区都不同）。对应 cuda 上 tensor 的缓冲区还会通过 ``cudaHostRegister`` 锁页，使得
+    :func:`_parallel_d2h` 中的拷贝可以真正地异步进行。
+
+    :param state_dict: 模型的 ``state_dict``；
+    """
+    def __init__(self, state_dict: Dict):
+        self.signature = _state_dict_signature(state_dict)
+        self.buffers = {}
+        self._registered = []
+        # 拷贝时使用的 cuda stream ，由 _parallel_d2h 在第一次保存时创建
+        self.cuda_streams = {}
+        for name, value in state_dict.items():
+            if isinstance(value, torch.Tensor):
+                buffer = torch.empty(value.shape, dtype=value.dtype).share_memory_()
+                if value.is_cuda and buffer.numel() > 0:
+                    self._pin(buffer)
+                self.buffers[name] = buffer
+
+    def _pin(self, buffer: "torch.Tensor"):
+        cudart = torch.cuda.cudart()
+        ret = cudart.cudaHostRegister(buffer.data_ptr(), buffer.numel() * buffer.element_size(), 0)
+        if int(ret) == 0:
+            self._registered.append(buffer)
+        else:
+            # 锁页失败时仍然可以进行拷贝，只是无法与其它拷贝重叠
+            logger.rank_zero_warning(f"Fail to page-lock the checkpoint staging buffer (cuda error:{int(ret)}), "
+                                     f"saving checkpoint may be slower.", once=True)
+
+    def match(self, state_dict: Dict) -> bool:
+        """
+        判断 ``state_dict`` 的拓扑结构是否与本计划一致。
+        """
+        return _state_dict_signature(state_dict) == self.signature
+
+    def release(self):
+        """
+        解除缓冲区的锁页。该计划不再使用时需要调用，调用之后不能再使用该计划。
+        """
+        if len(self._registered) > 0:
+            cudart = torch.cuda.cudart()
+            for buffer in self._registered:
+                cudart.cudaHostUnregister(buffer.data_ptr())
+            self._registered = []
+        self.buffers = {}
+        self.cuda_streams = {}
+
+
+def _parallel_d2h(copy_pairs: List[Tuple["torch.Tensor", "torch.Tensor"]], streams: Dict, num_streams: int = 4):
+    """
+    将 cuda 上的 tensor 拷贝到 cpu 的缓冲区中。tensor 会按照顺序轮流分配到 ``num_streams`` 个 cuda stream 上异步地拷贝，使得
+    多个拷贝操作可以同时进行，该函数会等待所有的拷贝完成后才返回。
+
+    :param copy_pairs: 由 ``(cpu 上的缓冲区, cuda 上的 tensor)`` 组成的列表，缓冲区应当已经锁页；
+    :param streams: 每个 cuda 设备上使用的 stream 列表，key 为设备。对于还没有出现过的设备会新建 stream 并加入其中，从而可以在
+        多次调用之间复用；
+    :param num_streams: 每个 cuda 设备上使用的 stream 数量；
+    """
+    used_devices = set()
+    for idx, (buffer, tensor) in enumerate(copy_pairs):
+        device = tensor.device
+        if device not in used_devices:
+            used_devices.add(device)
+            if device not in streams:
+                streams[device] = [torch.cuda.Stream(device=device) for _ in range(num_streams)]
+            # 保证拷贝发生在当前 stream 上已经提交的计算完成之后
+            current_stream = torch.cuda.current_stream(device)
+            for stream in streams[device]:
+                stream.wait_stream(current_stream)
+        stream = streams[device][idx % len(streams[device])]
+        with torch.cuda.stream(stream):
+            buffer.copy_(tensor, non_blocking=True)
+
+    events = []
+    for device in used_devices:
+        for stream in streams[device]:
+            events.append(stream.record_event())
+    # 事件句柄无法在进程之间可靠地传递，因此在交给子进程之前先在这里等待拷贝完成；
+    for event in events:
+        event.synchronize()
+
+
+def _stage_state_dict(state_dict: Dict, plan: _StagingPlan) -> Dict:
+    """
+    将 ``state_dict`` 中的 tensor 拷贝到 ``plan`` 预先分配好的 cpu 缓冲区中。位于 cuda 上的 tensor 会通过 :func:`_parallel_d2h`
+    并行地拷贝到锁页的缓冲区中，使用的 cuda stream 同样缓存在 ``plan`` 中。
+
+    :param state_dict: 模型的 ``state_dict``；
+    :param plan: 与 ``state_dict`` 拓扑结构一致的 :class:`_StagingPlan`；
+    :return: 一个新的字典，其中的 tensor 均为 ``plan`` 中位于共享内存的缓冲区，与原模型不再共享内存；
+    """
+    cpu_states = {}
+    cuda_copy_pairs = []
+    for name, value in state_dict.items():
+        if not isinstance(value, torch.Tensor):
+            cpu_states[name] = value
+            continue
+        buffer = plan.buffers[name]
+        value = value.detach()
+        if value.is_cuda:
+            cuda_copy_pairs.append((buffer, value))
+        else:
+            buffer.copy_(value)
+        cpu_states[name] = buffer
+    if len(cuda_copy_pairs) > 0:
+        _parallel_d2h(cuda_copy_pairs, plan.cuda_streams)
+    return cpu_states
+
+
+def _checkpoint_worker_loop(job_queue, done_queue):
+    """
+    子进程的主循环，不断地从 ``job_queue`` 中取出 ``(filepath, states)`` 并保存，直到取到 ``None`` 为止。每一次保存的结果都会通过
+    ``done_queue`` 返回，第二个元素为 ``None`` 说明保存成功，否则为出错的信息。
+
+    保存时先写入同一文件夹下的临时文件，写入成功后再替换为 ``filepath`` ，从而即使保存过程中进程退出，也不会留下不完整的
+    ``filepath`` 。
+    """
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        filepath, states = job
+        tmp_filepath = f"{filepath}.tmp"
+        try:
+            torch.save(states, tmp_filepath)
+            os.replace(tmp_filepath, filepath)
+            done_queue.put((filepath, None))
+        except BaseException as e:
+            if os.path.isfile(tmp_filepath):
+                os.remove(tmp_filepath)
+            done_queue.put((filepath, repr(e)))
+
+
+class _CheckpointWorker:
+    """
+    管理一个常驻的保存子进程。子进程在第一次调用 :meth:`submit` 时才会通过 ``spawn`` 的方式启动，因此只有真正执行保存的 rank 上
+    才会有该子进程。同一时刻最多只有一个保存任务在执行，新的任务提交前会等待上一个任务完成。
+    """
+    def __init__(self):
+        self._process = None
+        self._job_queue = None
+        self._done_queue = None
+        self._num_pending = 0
+
+    def _start(self):
+        ctx = mp.get_context('spawn')
+        self._job_queue = ctx.Queue()
+        self._done_queue = ctx.Queue()
+        self._process = ctx.Process(target=_checkpoint_worker_loop, args=(self._job_queue, self._done_queue),
+                                    daemon=True)
+        self._process.start()
+
+    def submit(self, filepath: Union[str, Path], states: Dict):
+        """
+        将已经位于 cpu 上的 ``states`` 交给子进程保存到 ``filepath`` 中，该函数不等待保存完成就返回。
+
+        :param filepath: 保存的文件路径；
+        :param states: 需要保存的内容，应当已经通过 :func:`_stage_state_dict` 拷贝到了 cpu 上。在该任务完成之前（见
+            :meth:`wait_for_pending` ），不能修改其中的 tensor；
+        """
+        if self._process is None:
+            self._start()
+        self.wait_for_pending()
+        self._job_queue.put((str(filepath), states))
+        self._num_pending += 1
+
+    @property
+    def has_pending(self) -> bool:
+        """
+        是否还有已经提交但没有确认完成的保存任务。
+        """
+        return self._num_pending > 0
+
+    def wait_for_pending(self):
+        """
+        等待所有已经提交的保存任务完成。如果有任务保存失败，会在所有任务结束后抛出 :class:`RuntimeError` 。
+        """
+        errors = []
+        while self._num_pending > 0:
+            try:
+                filepath, error = self._done_queue.get(timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self._num_pending = 0
+                    raise RuntimeError("The checkpoint saving process exited unexpectedly.")
+                continue
+            self._num_pending -= 1
+            if error is not None:
+                errors.append(f"{filepath}: {error}")
+        if len(errors) > 0:
+            raise RuntimeError("Fail to save checkpoint to " + "; ".join(errors))
+
+    def close(self):
+        """
+        等待所有保存任务完成后结束子进程。
+        """
+        if self._process is None:
+            return
+        try:
+            self.wait_for_pending()
+        finally:
+            if self._process.is_alive():
+                self._job_queue.put(None)
+                self._process.join()
+            self._process = None
@@ -3,7 +3,7 @@ __all__ = [
     'prepare_jittor_dataloader'
 ]
 
-from typing import Callable, Optional, List, Union, Dict, Sequence
+from typing import Callable, Optional, Union, Dict, Sequence
 from copy import deepcopy
 
 import numpy as np
@@ -30,6 +30,7 @@ class _JittorDataset(Dataset):
     def __init__(self, dataset) -> None:
         super(_JittorDataset, self).__init__()
         self.dataset = dataset
+        # 样本数量只在这里获取一次；不重写 __len__ ，JittorDataLoader.__len__ 依赖 jittor Dataset 按 batch 计数的 __len__
         self.total_len = len(dataset)
 
     def __getitem__(self, item):
@@ -83,7 +84,7 @@ class JittorDataLoader:
                  collate_fn: Union[None, str, Callable] = "auto") -> None:
 
         # TODO 验证支持replacesampler （以后完成） 增加Sampler
-        # 将内部dataset批次设置为1
+        # 将内部dataset批次设置为1，需要在 _JittorDataset 通过 len(dataset) 获取样本数量之前进行
         if isinstance(dataset, Dataset):
             dataset.set_attrs(batch_size=1, shuffle=False, endless=False)
 
@@ -111,11 +112,13 @@ class JittorDataLoader:
         else:
             self.collate_fn = collate_batch
 
+        # collate_fn 只在这里包裹一次，之后通过 set_pad 和 set_ignore 对 Collator 的修改仍然有效
         self.dataset.set_attrs(batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
                                num_workers=num_workers, buffer_size=buffer_size, stop_grad=stop_grad,
-                               keep_numpy_array=keep_numpy_array, endless=endless)
+                               keep_numpy_array=keep_numpy_array, endless=endless,
+                               collate_batch=indice_collate_wrapper(self.collate_fn))
 
-        self.cur_batch_indices = None
+        self.cur_batch_indices = np.empty(0, dtype=np.int32)
 
     def __getattr__(self, attr):
         if attr in ["batch_size", "shuffle", "drop_last", "num_workers", "buffer_size", "stop_grad",
@@ -124,11 +127,9 @@ class JittorDataLoader:
         raise AttributeError(f"{self} has not attribute '{attr}'")
 
     def __iter__(self):
-        # TODO 第一次迭代后不能设置collate_fn，设置是无效的
-        if self.cur_batch_indices is None:
-            self.dataset.set_attrs(collate_batch=indice_collate_wrapper(self.collate_fn))
-        for indices, data in self.dataset.__iter__():
-            self.cur_batch_indices = indices
+        for indices, data in self.dataset:
+            # jittor 会把 collate 结果中的 np.ndarray 转为 jittor.Var ，因此在取出之后再转为 np.ndarray
+            self.cur_batch_indices = np.asarray(indices, dtype=np.int32)
             yield data
 
     def __len__(self):
@@ -192,11 +193,11 @@ class JittorDataLoader:
         else:
             raise ValueError(f"Only when the collate_fn is a fastNLP Collator, set_ignore() is allowed.")
 
-    def get_batch_indices(self) -> List[int]:
+    def get_batch_indices(self) -> np.ndarray:
         """
         获取当前 ``batch`` 中每条数据对应的索引。
 
-        :return: 当前 ``batch`` 数据的索引；
+        :return: 当前 ``batch`` 数据的索引，为 ``dtype`` 是 ``np.int32`` 的 :class:`numpy.ndarray` ；
         """
         return self.cur_batch_indices
 
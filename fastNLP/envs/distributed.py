@@ -75,11 +75,13 @@ def fastnlp_no_sync_context(level: int = 2):
     """
     old_level = os.environ.get(FASTNLP_NO_SYNC, None)
     os.environ[FASTNLP_NO_SYNC] = f'{level}'
-    yield
-    if old_level is None:
-        os.environ.pop(FASTNLP_NO_SYNC)
-    else:
-        os.environ[FASTNLP_NO_SYNC] = old_level
+    try:
+        yield
+    finally:
+        if old_level is None:
+            os.environ.pop(FASTNLP_NO_SYNC)
+        else:
+            os.environ[FASTNLP_NO_SYNC] = old_level
 
 
 @contextmanager
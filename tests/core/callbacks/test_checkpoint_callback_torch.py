@@ -20,6 +20,7 @@ from fastNLP.core.log import logger
 
 from fastNLP.envs.imports import _NEED_IMPORT_TORCH
 if _NEED_IMPORT_TORCH:
+    import torch
     from torch.utils.data import DataLoader
     from torch.optim import SGD
     import torch.distributed as dist
@@ -506,6 +507,42 @@ def test_load_state(model_and_optimizers):
         Trainer._custom_callbacks.clear()
 
 
+@pytest.mark.torch
+@pytest.mark.parametrize("driver,device", [("torch", "cpu"), ("torch", 0)])
+def test_async_save(model_and_optimizers, driver, device):
+    if device != 'cpu' and not torch.cuda.is_available():
+        pytest.skip("No cuda, cannot test saving from gpu.")
+    try:
+        path = Path.cwd().joinpath(f"test_model_checkpoint")
+        path.mkdir(exist_ok=True, parents=True)
+
+        callbacks = [CheckpointCallback(folder=path, every_n_epochs=1, save_object='model', async_save=True)]
+        trainer = Trainer(
+            model=model_and_optimizers.model,
+            driver=driver,
+            device=device,
+            optimizers=model_and_optimizers.optimizers,
+            train_dataloader=model_and_optimizers.train_dataloader,
+            evaluate_dataloaders=model_and_optimizers.evaluate_dataloaders,
+            input_mapping=model_and_optimizers.input_mapping,
+            output_mapping=model_and_optimizers.output_mapping,
+            metrics=model_and_optimizers.metrics,
+            n_epochs=3,
+            callbacks=callbacks,
+            output_from_new_proc="all"
+        )
+        trainer.run(num_eval_sanity_batch=0, num_train_batch_per_epoch=2)
+
+        # on_train_end 时会等待所有的保存任务完成
+        all_saved_model_paths = {w.name: w for w in path.joinpath(os.environ[FASTNLP_LAUNCH_TIME]).iterdir()}
+        assert len(all_saved_model_paths) == 3
+        for folder in all_saved_model_paths.values():
+            trainer.load_model(folder, only_state_dict=True)
+
+    finally:
+        rank_zero_rm(path)
+
+
 @pytest.mark.torch
 # 通过自己编写 model_save_fn 和 model_load_fn 来测试 huggingface 的 transformers 的模型的保存和加载；
 @pytest.mark.parametrize("driver,device", [("torch", [6, 7]), ("torch", 7)])  # ("torch", "cpu"), ("torch", [0, 1]), ("torch", 1)
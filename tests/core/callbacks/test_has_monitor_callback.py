@@ -0,0 +1,12 @@
+from fastNLP.core.callbacks.has_monitor_callback import ResultsMonitor
+
+
+class TestResultsMonitor:
+    def test_itemize_results_not_mutate_input(self):
+        monitor = ResultsMonitor('acc')
+        results = {'acc#acc': 0.5, 'loss#loss': 2, 'name': 'dev', 'empty': None}
+        out = monitor.itemize_results(results)
+        assert out == results and out is not results
+        out['step'] = 3
+        assert 'step' not in results
+
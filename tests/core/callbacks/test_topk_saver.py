@@ -0,0 +1,38 @@
+from fastNLP.core.callbacks.topk_saver import TopkQueue
+
+
+class TestTopkQueue:
+    def test_push(self):
+        queue = TopkQueue(topk=2)
+        assert queue.push('a', 0.1) == (None, None)
+        assert queue.push('b', 0.3) == (None, None)
+        # 不满足 topk，被退回
+        assert queue.push('c', 0.05) == ('c', 0.05)
+        # 挤出最差的记录
+        assert queue.push('d', 0.2) == ('a', 0.1)
+        # 相同的 value 时，挤出更早推入的记录
+        assert queue.push('e', 0.2) == ('d', 0.2)
+        assert queue.topk_dict == {'b': 0.3, 'e': 0.2}
+        assert queue.push('f', None) == ('f', None)
+
+    def test_topk_special_value(self):
+        queue = TopkQueue(topk=0)
+        assert queue.push('a', 0.1) == ('a', 0.1)
+        assert not queue
+
+        queue = TopkQueue(topk=-1)
+        for i in range(5):
+            assert queue.push(str(i), i) == (None, None)
+
+    def test_state_dict(self):
+        queue = TopkQueue(topk=2)
+        queue.push('a', 0.1)
+        queue.push('b', 0.3)
+        states = queue.state_dict()
+        assert states == {'a': 0.1, 'b': 0.3}
+
+        new_queue = TopkQueue(topk=2)
+        new_queue.load_state_dict(states)
+        assert new_queue.topk_dict == states
+        assert new_queue.push('c', 0.2) == ('a', 0.1)
+        assert new_queue.push('d', 0.05) == ('d', 0.05)
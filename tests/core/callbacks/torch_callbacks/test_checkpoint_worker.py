@@ -0,0 +1,206 @@
+import os
+import pytest
+
+from fastNLP.core.callbacks.topk_saver import Saver, TopkSaver
+from fastNLP.core.callbacks.torch_callbacks import checkpoint_worker
+from fastNLP.core.callbacks.torch_callbacks.checkpoint_worker import _CheckpointWorker, _StagingPlan, \
+    _stage_state_dict, _checkpoint_barrier
+from fastNLP.envs import FASTNLP_LAUNCH_TIME
+from fastNLP.envs.env import FASTNLP_MODEL_FILENAME, FASTNLP_NO_SYNC
+from fastNLP.envs.imports import _NEED_IMPORT_TORCH
+
+if _NEED_IMPORT_TORCH:
+    import torch
+    import torch.distributed as dist
+    from fastNLP.core.drivers.torch_driver import TorchSingleDriver, TorchDDPDriver
+    from fastNLP.core.drivers.torch_driver.ddp import find_free_network_port
+
+
+class _SaveModelTrainer:
+    """
+    只实现了 save_model 的 trainer ，用于直接测试 Saver 的异步保存。
+    """
+    def __init__(self, model, device='cpu'):
+        self.driver = TorchSingleDriver(model, torch.device(device))
+        self.cur_epoch_idx = 1
+        self.global_forward_batches = 0
+
+    def save_model(self, folder, only_state_dict=True, model_save_fn=None, **kwargs):
+        model_save_fn(folder)
+
+
+@pytest.fixture
+def saver(tmp_path, monkeypatch):
+    monkeypatch.setenv(FASTNLP_LAUNCH_TIME, 'async_save')
+    saver = Saver(folder=tmp_path, async_save=True)
+    yield saver
+    saver.teardown()
+
+
+@pytest.mark.torch
+class TestCheckpointWorker:
+    def test_reuse_shared_buffers(self, tmp_path):
+        model = torch.nn.Linear(4, 2)
+        plan = _StagingPlan(model.state_dict())
+        data_ptrs = {name: buffer.data_ptr() for name, buffer in plan.buffers.items()}
+        assert all(buffer.is_shared() for buffer in plan.buffers.values())
+
+        worker = _CheckpointWorker()
+        try:
+            for idx in range(2):
+                with torch.no_grad():
+                    model.weight.fill_(idx)
+                states = _stage_state_dict(model.state_dict(), plan)
+                worker.submit(tmp_path.joinpath(f'{idx}.pkl'), states)
+                worker.wait_for_pending()
+                # 交给子进程之后缓冲区没有被移动到新的共享内存中
+                assert {name: buffer.data_ptr() for name, buffer in plan.buffers.items()} == data_ptrs
+                assert torch.equal(torch.load(tmp_path.joinpath(f'{idx}.pkl'))['weight'], model.weight.detach())
+                assert not tmp_path.joinpath(f'{idx}.pkl.tmp').exists()
+        finally:
+            worker.close()
+            plan.release()
+
+    def test_save_failure(self, tmp_path):
+        worker = _CheckpointWorker()
+        try:
+            # 目标路径是一个文件夹，子进程中的保存会失败
+            worker.submit(tmp_path, {'weight': torch.zeros(2)})
+            with pytest.raises(RuntimeError):
+                worker.wait_for_pending()
+            assert not worker.has_pending
+            assert not os.path.exists(f"{tmp_path}.tmp")
+        finally:
+            worker.close()
+
+    def test_parallel_d2h(self):
+        if not torch.cuda.is_available():
+            pytest.skip("No cuda, cannot test copying from gpu.")
+        tensors = [torch.randn(16, 16, device='cuda') for _ in range(6)]
+        plan = _StagingPlan({idx: tensor for idx, tensor in enumerate(tensors)})
+        try:
+            assert all(buffer.is_pinned() for buffer in plan.buffers.values())
+            streams = None
+            for _ in range(2):
+                for tensor in tensors:
+                    tensor.add_(1)
+                states = _stage_state_dict({idx: tensor for idx, tensor in enumerate(tensors)}, plan)
+                for idx, tensor in enumerate(tensors):
+                    assert torch.equal(states[idx], tensor.cpu())
+                # 多次保存之间复用同样的 stream
+                if streams is None:
+                    streams = {device: list(device_streams) for device, device_streams in plan.cuda_streams.items()}
+                assert plan.cuda_streams == streams
+        finally:
+            plan.release()
+
+    def test_saver_reuse_plan(self, saver):
+        trainer = _SaveModelTrainer(torch.nn.Linear(4, 2))
+        saver.save(trainer, 'first')
+        plan = saver._cached_save_plan
+        data_ptrs = {name: buffer.data_ptr() for name, buffer in plan.buffers.items()}
+
+        saver.save(trainer, 'second')
+        assert saver._cached_save_plan is plan
+        assert {name: buffer.data_ptr() for name, buffer in plan.buffers.items()} == data_ptrs
+
+        # 拓扑变化后需要重新生成保存计划
+        trainer.driver.model = torch.nn.Linear(4, 3)
+        folder = saver.save(trainer, 'third')
+        assert saver._cached_save_plan is not plan
+        saver.checkpoint_worker.wait_for_pending()
+        assert torch.load(f'{folder}/{FASTNLP_MODEL_FILENAME}')['weight'].shape == (3, 4)
+
+        plan = saver._cached_save_plan
+        saver.load_state_dict(saver.state_dict())
+        assert saver._cached_save_plan is None
+        saver.save(trainer, 'fourth')
+        assert saver._cached_save_plan is not plan
+
+
+@pytest.mark.torch
+def test_topk_evict_after_saved(tmp_path, monkeypatch):
+    monkeypatch.setenv(FASTNLP_LAUNCH_TIME, 'async_save')
+    saver = TopkSaver(topk=1, monitor='acc', folder=tmp_path, async_save=True)
+    trainer = _SaveModelTrainer(torch.nn.Linear(4, 2))
+    try:
+        first = saver.save_topk(trainer, {'acc': 0.1})
+        trainer.global_forward_batches += 1
+        second = saver.save_topk(trainer, {'acc': 0.2})
+        # 新的 checkpoint 确认保存成功之后才删除被淘汰的 checkpoint
+        saver._wait_for_async_save()
+        assert not os.path.exists(first)
+        assert os.path.exists(os.path.join(second, FASTNLP_MODEL_FILENAME))
+
+        # 使得下一次的保存失败
+        trainer.global_forward_batches += 1
+        key = f"model-epoch_{trainer.cur_epoch_idx}-batch_{trainer.global_forward_batches}-acc_0.3"
+        saver.timestamp_path.joinpath(key, FASTNLP_MODEL_FILENAME).mkdir(parents=True)
+        saver.save_topk(trainer, {'acc': 0.3})
+        # 训练中的下一次保存会抛出异常，而训练结束时只会报告错误
+        with pytest.raises(RuntimeError):
+            saver._wait_for_async_save()
+        assert os.path.exists(os.path.join(second, FASTNLP_MODEL_FILENAME))
+        saver.teardown()
+        assert saver.checkpoint_worker._process is None
+    finally:
+        saver.teardown()
+
+
+class _RecordSyncTrainer:
+    """
+    记录 save_model 被调用时 FASTNLP_NO_SYNC 的值。
+    """
+    def __init__(self, driver, raise_exception=False):
+        self.driver = driver
+        self.no_sync_levels = []
+        self.raise_exception = raise_exception
+
+    def save_model(self, folder, only_state_dict=True, model_save_fn=None, **kwargs):
+        self.no_sync_levels.append(os.environ.get(FASTNLP_NO_SYNC))
+        if self.raise_exception:
+            raise RuntimeError("Fail to save.")
+
+
+@pytest.mark.torch
+def test_checkpoint_group(tmp_path, monkeypatch):
+    monkeypatch.setenv(FASTNLP_LAUNCH_TIME, 'checkpoint_group')
+    monkeypatch.delenv(FASTNLP_NO_SYNC, raising=False)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{find_free_network_port()}', rank=0, world_size=1)
+    try:
+        driver = TorchDDPDriver.__new__(TorchDDPDriver)
+        trainer = _RecordSyncTrainer(driver)
+
+        # 同步保存时不创建通信组，保存行为不变
+        saver = Saver(folder=tmp_path, async_save=False)
+        saver.init_checkpoint_group(driver)
+        assert saver.checkpoint_group is None
+        saver.save(trainer, 'sync')
+        assert trainer.no_sync_levels == [None]
+
+        # 不支持异步保存的参数下同样不创建
+        saver = Saver(folder=tmp_path, async_save=True, model_save_fn=lambda folder: None)
+        saver.init_checkpoint_group(driver)
+        assert saver.checkpoint_group is None
+
+        saver = Saver(folder=tmp_path, async_save=True)
+        saver.init_checkpoint_group(driver)
+        assert saver.checkpoint_group is not None
+        saver.save(trainer, 'async')
+        assert trainer.no_sync_levels == [None, '1']
+        assert FASTNLP_NO_SYNC not in os.environ
+
+        # 保存出错时也需要恢复 FASTNLP_NO_SYNC
+        with pytest.raises(RuntimeError):
+            saver.save(_RecordSyncTrainer(driver, raise_exception=True), 'error')
+        assert FASTNLP_NO_SYNC not in os.environ
+        saver.teardown()
+
+        barriers = []
+        monkeypatch.setattr(checkpoint_worker.dist, 'barrier', lambda group: barriers.append(group))
+        _checkpoint_barrier(saver.checkpoint_group)
+        monkeypatch.setenv(FASTNLP_NO_SYNC, '1')
+        _checkpoint_barrier(saver.checkpoint_group)
+        assert barriers == [saver.checkpoint_group]
+    finally:
+        dist.destroy_process_group()
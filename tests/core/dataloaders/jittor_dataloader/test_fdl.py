@@ -62,6 +62,17 @@ class TestJittor:
         for batch in jtl1:
             print(batch)
 
+    def test_get_batch_indices(self):
+        dataset = Fdataset({'x': [[1, 2], [0], [2, 3, 4, 5]] * 10, 'y': [0, 1, 2] * 10})
+        jtl = JittorDataLoader(dataset, batch_size=3, shuffle=True)
+        all_indices = []
+        for batch in jtl:
+            indices = jtl.get_batch_indices()
+            assert isinstance(indices, np.ndarray) and indices.dtype == np.int32
+            assert len(indices) == 3
+            all_indices.extend(indices.tolist())
+        assert sorted(all_indices) == list(range(30))
+
     def test_huggingface_datasets(self):
         dataset = HfDataset.from_dict({'x': [[1, 2], [0], [2, 3, 4, 5]] * 100, 'y': [0, 1, 2] * 100})
         jtl = JittorDataLoader(dataset, batch_size=4, drop_last=True, shuffle=False)
@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+from fastNLP.envs.distributed import fastnlp_no_sync_context
+from fastNLP.envs.env import FASTNLP_NO_SYNC
+
+
+@pytest.mark.parametrize('old_level', [None, '2'])
+def test_fastnlp_no_sync_context_restore_on_exception(old_level, monkeypatch):
+    if old_level is None:
+        monkeypatch.delenv(FASTNLP_NO_SYNC, raising=False)
+    else:
+        monkeypatch.setenv(FASTNLP_NO_SYNC, old_level)
+    with pytest.raises(RuntimeError):
+        with fastnlp_no_sync_context(level=1):
+            assert os.environ[FASTNLP_NO_SYNC] == '1'
+            raise RuntimeError
+    assert os.environ.get(FASTNLP_NO_SYNC) == old_level